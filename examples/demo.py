@@ -0,0 +1,55 @@
+"""
+本地调试脚本：不经过 AstrBot 插件流程，直接调用 markdown_to_image_playwright 生成图片。
+
+在插件目录下运行（需要已安装 AstrBot 与插件依赖的环境）：python examples/demo.py
+"""
+import asyncio
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import markdown_to_image_playwright  # noqa: E402
+
+markdown_string = """
+# Playwright 渲染测试
+
+这是一个宽度被设置为 600px 的示例。当文本内容足够长时，它会自动换行以适应设定的宽度。
+
+行内公式 $a^2 + b^2 = c^2$。
+
+独立公式：
+$$
+\\int_0^\\infty e^{-x^2} dx = \\frac{\\sqrt{\\pi}}{2}
+$$
+
+以及一段 C++ 代码:
+```cpp
+#include <iostream>
+
+int main() {
+    std::cout << "Hello, C++!" << std::endl;
+    return 0;
+}
+```
+"""
+
+
+if __name__ == "__main__":
+    # 生成一个固定宽度的图片
+    output_file_fixed_width = f"markdown_width_{uuid.uuid4().hex[:6]}.png"
+    asyncio.run(markdown_to_image_playwright(
+        markdown_string,
+        output_file_fixed_width,
+        scale=2,
+        width=1000  # 设置宽度为 600px
+    ))
+
+    # 生成一个自适应宽度的图片(不设置 width 参数)
+    output_file_auto_width = f"markdown_auto_{uuid.uuid4().hex[:6]}.png"
+    asyncio.run(markdown_to_image_playwright(
+        markdown_string,
+        output_file_auto_width,
+        scale=2
+    ))
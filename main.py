@@ -1,12 +1,22 @@
 import os
 import re
-import uuid
 import json
+import html
 import hashlib
-from typing import List
-
-
-from astrbot.api import logger
+import functools
+import io
+import mmap
+import base64
+import itertools
+import collections
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from urllib.parse import urlparse
+
+
+from astrbot.api import logger, AstrBotConfig
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
 from astrbot.core.message.components import Image, Plain
@@ -20,37 +30,447 @@ import asyncio
 from playwright.async_api import async_playwright
 import sys
 
+# 可选依赖：安装了 cmarkgfm（C 扩展）时用它解析 Markdown，比纯 Python 的 mistune 快一个数量级
+try:
+    import cmarkgfm
+    from cmarkgfm.cmark import Options as CmarkOptions
+except ImportError:
+    cmarkgfm = None
+
+# 可选依赖：安装了 orjson 时用它解析对话历史（其中含大量 base64 图片），比标准库 json 快数倍
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 可选依赖：安装了 xxhash 时用 xxh3_128 计算缓存键，比 blake2b 快数倍
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 可选依赖：安装了 Pillow 时，纯文本类的简单 <md> 块可不经浏览器直接绘制
+try:
+    from PIL import Image as PILImage, ImageDraw, ImageFont
+except ImportError:
+    PILImage = None
+
+# 可选依赖：同时安装了 Pygments 与 Pillow 时，仅含一个代码块的 <md> 块直接高亮绘制
+try:
+    import pygments
+    from pygments.formatters import ImageFormatter
+    from pygments.lexers import TextLexer, get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+
+# 常驻浏览器的启动参数
+BROWSER_LAUNCH_ARGS = [
+    # 容器/低权限环境下禁用沙箱，并避免 /dev/shm 过小导致崩溃
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    # 池中的页面始终处于“后台”，禁止 Chromium 对其节流，避免并发渲染时偶发的数秒卡顿
+    "--disable-background-timer-throttling",
+    "--disable-renderer-backgrounding",
+    "--disable-backgrounding-occluded-windows",
+    # 一次性截图用不到的子系统与首次运行流程。
+    # 不要传 --disable-features：Chromium 只认最后一个该参数，会覆盖 Playwright 自带的禁用列表
+    # （其中已包含 Translate、MediaRouter、AcceptCHFrame 等）
+    "--disable-extensions",
+    "--disable-sync",
+    "--disable-gpu",
+    "--disable-background-networking",
+    "--no-first-run",
+    "--mute-audio",
+    # 截图不应带滚动条；关闭字体 hinting 使不同系统上的文字渲染保持一致
+    "--hide-scrollbars",
+    "--font-render-hinting=none",
+]
+
+# <md> 渲染参数：2 倍缩放以获得更高清的图片；固定宽度 600px，内容过长会自动换行
+RENDER_SCALE = 2
+RENDER_WIDTH = 600
+
+# 缓存图片格式（可通过插件配置 image_format 修改）：文字截图在 JPEG quality 90 下与 PNG
+# 肉眼无差别，但编码更快、文件更小。Playwright 截图只支持 png 与 jpeg
+IMAGE_FORMAT = "jpeg"
+IMAGE_EXTENSIONS = {"jpeg": "jpg", "png": "png"}
+JPEG_QUALITY = 90
+
+# 常驻 Chromium 实例数量。多个浏览器分摊截图负载，但过多反而因争抢 CPU 变慢
+BROWSER_POOL_SIZE = 2
+
+# 每个浏览器累计渲染这么多次后关闭并重启，回收 Chromium 长时间运行积累的内存
+BROWSER_RECYCLE_AFTER = 50
+
+# 预排版公式 HTML 的缓存条目上限（按 (tex, 是否独立公式) 缓存）
+FORMULA_CACHE_SIZE = 2048
+
+# 每种缩放因子预热的 Page 数量（同时也是该缩放因子下的最大并发渲染数），
+# 这些 Page 轮流分布在各个浏览器上
+PAGE_POOL_SIZE = 4
+
+# 公式页面创建/排版失败（如离线环境无法从 CDN 加载 KaTeX）后，暂停这么多秒再重试，
+# 期间含公式的内容直接交由渲染页面自行排版
+MATH_PAGE_RETRY_INTERVAL = 300
+
+# 启动时预渲染的超时（秒）
+WARM_UP_TIMEOUT = 15
+
+# 插件加载期间（安装/预热浏览器）到来的渲染请求最多等待的秒数
+BROWSER_READY_TIMEOUT = 120
+
+# 单个 <md> 块的最大字符数，超出部分截断，避免异常冗长的输出长时间占用浏览器及内存
+MAX_MD_LENGTH = 200_000
+# 等待公式字体及截图的超时（秒），防止单个异常页面一直占住 Page 池
+SCREENSHOT_TIMEOUT = 20
+
+# 缓存命中的内存索引条目上限（缓存键 -> 图片路径），命中时省去 stat 系统调用
+CACHE_INDEX_SIZE = 512
+# 写入对话历史的图片 base64 缓存总大小上限（字节，按缓存图片路径）。
+# 单张渲染图的 base64 可达数百 KB，只缓存最近几张，重复写入历史时省去读文件与编码
+BASE64_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# 磁盘缓存清理：每 CACHE_SWEEP_INTERVAL 秒检查一次，删除超过 CACHE_MAX_AGE_DAYS 天未使用的图片，
+# 总大小仍超过上限（插件配置 cache_max_mb）时再按最久未使用的顺序删除
+CACHE_MAX_AGE_DAYS = 7
+CACHE_MAX_MB = 256
+CACHE_SWEEP_INTERVAL = 600
+
+
+def _render_cache_key(md_text: str, scale: int, width: int = None) -> str:
+    """
+    计算渲染结果的缓存键。
 
-async def markdown_to_image_playwright(
-    md_text: str,
-    output_image_path: str,
-    scale: int = 2,
-    width: int = None
-):
+    缩放因子和宽度都会影响输出图片，因此一并计入。这里只需要文件名级别的去重，
+    不需要密码学强度：优先用 xxh3_128，未安装 xxhash 时用 blake2b（仍比 sha256 快）。
+    两者都输出 32 位十六进制字符串。
     """
-    使用 Playwright 将包含 LaTeX 的 Markdown 转换为图片。
+    payload = f"{scale}|{width}|{md_text}".encode("utf-8")
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(payload)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
 
-    :param md_text: Markdown 格式的字符串。
-    :param output_image_path: 图片输出路径。
-    :param scale: 渲染的缩放因子。大于 1 的值可以有效提升清晰度和抗锯齿效果。
-    :param width: 图片内容的固定宽度（单位：像素）。如果为 None，则宽度自适应内容。
+
+def _cache_file_path(cache_dir: str, key: str, extension: str) -> str:
+    """
+    缓存图片路径：按缓存键前两位分到 256 个子目录，避免单个目录中文件过多拖慢查找。
+    """
+    return os.path.join(cache_dir, key[:2], f"{key}.{extension}")
+
+
+def _iter_cache_files(cache_dir: str):
+    """遍历缓存目录中的文件（含各分片子目录），逐个产出 os.DirEntry。"""
+    try:
+        entries = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                # 目录可能已被并发删除，此时跳过即可
+                yield from os.scandir(entry.path)
+            elif entry.is_file():
+                # 分片之前的旧缓存文件直接位于缓存目录下，同样参与索引与清理
+                yield entry
+        except OSError:
+            continue
+
+
+def _prune_cache_dir(
+    cache_dir: str, max_age_days: float, max_bytes: int = None, keep=frozenset(), touched=None
+) -> int:
+    """
+    清理缓存目录：先删除超过 max_age_days 天未修改的文件，总大小仍超过 max_bytes 时
+    再从最旧的文件开始删除。
+
+    :param keep: 不参与清理的文件路径（如内存索引中近期命中的图片）。
+    :param touched: 文件路径 -> 最近一次使用的时间戳。清理前先写入为修改时间，
+        使按修改时间的淘汰顺序即最近最少使用顺序。
+    :return: 删除的文件数量。
+    """
+    for path, used_at in (touched or {}).items():
+        try:
+            os.utime(path, (used_at, used_at))
+        except OSError:
+            # 文件可能已被删除
+            continue
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    files = []
+    for entry in _iter_cache_files(cache_dir):
+        try:
+            if not entry.is_file() or entry.path in keep:
+                continue
+            stat = entry.stat()
+            if stat.st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            # 文件可能正被并发删除或替换，跳过即可
+            continue
+
+    if max_bytes is not None:
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for _, size, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+    return removed
+
+
+async def _iter_output_lines(stream):
+    """
+    逐行读取子进程输出。按块读取后自行切分，\r 也视为换行：下载进度条只用 \r 刷新，
+    StreamReader.readline 遇到超长的单“行”会抛出异常。
+    """
+    pending = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = b"" if lines[-1].endswith((b"\r", b"\n")) else lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _scan_cache_dir(cache_dir: str, extension: str, limit: int) -> List[Tuple[str, str]]:
+    """
+    扫描缓存目录中指定扩展名的非空图片，用于启动时预填内存索引。
+
+    :return: 最近修改的至多 limit 个 (缓存键, 路径)，按修改时间从旧到新排列。
+    """
+    suffix = "." + extension
+    found = []
+    for entry in _iter_cache_files(cache_dir):
+        if not entry.name.endswith(suffix):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if stat.st_size > 0:
+            found.append((stat.st_mtime, entry.name[:-len(suffix)], entry.path))
+    found.sort()
+    return [(key, path) for _, key, path in found[-limit:]]
+
+
+# 插件自带的静态资源目录。页面通过虚拟源 LOCAL_ASSET_ORIGIN 引用，由 page.route 直接读本地文件返回，
+# 不经过网络；需要保留目录结构，因为 KaTeX 的样式表按相对路径引用字体文件
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+LOCAL_ASSET_ORIGIN = "https://md2img.local/"
+
+# 优先使用打包在 assets/katex/ 下的 KaTeX 发行包，缺失时回退到 CDN
+if os.path.isfile(os.path.join(ASSETS_DIR, "katex", "katex.min.js")):
+    KATEX_BASE_URL = LOCAL_ASSET_ORIGIN + "katex/"
+else:
+    KATEX_BASE_URL = "https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/"
+
+# KaTeX 资源。仅在正文包含公式时注入，纯文本/代码渲染无需加载。
+# 公式通常已由插件预排版为 HTML（见 MarkdownConverterPlugin._typeset_formulas），页面只需样式表；
+# 无法预排版时（如独立调用）才注入脚本，在页面内一次性收集所有 .md2img-math 节点批量排版。
+# KaTeX 同步排版：脚本为阻塞加载，DOMContentLoaded 时完成渲染，早于 load 事件
+KATEX_CSS = """
+        <link rel="stylesheet" href="__KATEX_BASE_URL__katex.min.css">
+""".replace("__KATEX_BASE_URL__", KATEX_BASE_URL)
+KATEX_SCRIPTS = """
+        <script src="__KATEX_BASE_URL__katex.min.js"></script>
+        <script>
+            document.addEventListener("DOMContentLoaded", function () {
+                document.querySelectorAll(".md2img-math").forEach(function (el) {
+                    katex.render(el.textContent, el, {
+                        displayMode: el.classList.contains("md2img-display"),
+                        throwOnError: false
+                    });
+                });
+            });
+        </script>
+""".replace("__KATEX_BASE_URL__", KATEX_BASE_URL)
+
+# 专用于公式预排版的页面，只加载 KaTeX 脚本
+KATEX_PAGE_HTML = (
+    '<html><head><meta charset="UTF-8">'
+    f'<script src="{KATEX_BASE_URL}katex.min.js"></script>'
+    "</head><body></body></html>"
+)
+# 一次 evaluate 批量排版多个公式：[[tex, display], ...] -> [html, ...]
+_TYPESET_FORMULAS_JS = """
+(items) => items.map(([tex, display]) => katex.renderToString(tex, {
+    displayMode: display,
+    throwOnError: false
+}))
+"""
+
+# 公式提取：先匹配围栏代码块/行内代码、空行后缩进 4 格的代码块（不含缩进的子列表）
+# 以及转义的 \$ 与 \\（均原样保留，其中的 $ 不是公式），再匹配 $$...$$ 与 $...$。
+# 行内公式要求定界符内侧紧贴非空白字符，避免把 "$5 和 $10" 当成公式
+_MATH_RE = re.compile(
+    r"(```.*?```|~~~.*?~~~|`[^`\n]*`"
+    r"|(?:(?<=\n\n)|\A)(?:(?: {4}|\t)(?![ \t]*(?:[-+*]|\d+[.)])[ \t])[^\n]*(?:\n|\Z))+"
+    r"|\\[\\$])"
+    r"|\$\$(.+?)\$\$"
+    r"|\$([^\s$](?:[^$\n]*?[^\s$])?)\$",
+    re.DOTALL,
+)
+# <md>...</md> 块（group(1) 为块内容），或落单的 <md>/</md> 标签（group(1) 为 None）
+_MD_TAG_RE = re.compile(r"<md>(.*?)</md>|</?md>", re.DOTALL)
+
+# 公式在 Markdown 解析期间的占位符，纯字母数字，解析器会原样输出
+_MATH_PLACEHOLDER_RE = re.compile(r"MD2IMGMATH(\d+)X")
+
+
+async def _serve_local_asset(route):
+    """page.route 处理函数：把虚拟源下的请求映射到 ASSETS_DIR 中的文件。"""
+    rel_path = urlparse(route.request.url).path.lstrip("/")
+    local_path = os.path.normpath(os.path.join(ASSETS_DIR, rel_path))
+    if not local_path.startswith(ASSETS_DIR + os.sep) or not os.path.isfile(local_path):
+        await route.abort()
+        return
+    await route.fulfill(path=local_path)
+
+
+# 渲染页面允许访问的外部地址：KaTeX 回退到 CDN 时放行其目录（含字体）
+_ALLOWED_EXTERNAL_PREFIXES = (
+    () if KATEX_BASE_URL.startswith(LOCAL_ASSET_ORIGIN) else (KATEX_BASE_URL,)
+)
+
+
+async def _route_render_request(route):
+    """
+    context.route 处理函数：虚拟源请求读本地文件；正文中的远程图片属于用户内容，照常加载；
+    其余外部请求（原始 HTML 里的脚本、样式、字体、iframe 等）直接拦截，
+    避免 DNS/TLS 等待拖慢 load 事件。
+    """
+    request = route.request
+    url = request.url
+    if url.startswith(LOCAL_ASSET_ORIGIN):
+        await _serve_local_asset(route)
+    elif (
+        url.startswith(("http://", "https://"))
+        and request.resource_type != "image"
+        and not url.startswith(_ALLOWED_EXTERNAL_PREFIXES)
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+def _viewport_for_width(width: int = None) -> dict:
+    """
+    渲染页面的视口大小。截图按 body 区域整页截取，视口只影响排版宽度，
+    固定宽度时收窄到刚好容纳正文，减少 Chromium 为视口分配的内存；高度随意取小值。
     """
-    # 1. 根据是否提供了 width 参数，动态生成 body 的宽度样式
-    width_style = ""
     if width:
-        # box-sizing: border-box 可确保 padding 包含在设定的 width 内
-        width_style = f"width: {width}px; box-sizing: border-box;"
+        # body 默认 8px 外边距
+        return {"width": width + 2 * 8, "height": 100}
+    # 自适应宽度时沿用 Playwright 默认宽度，避免改变自动换行的位置
+    return {"width": 1280, "height": 100}
+
+
+async def _new_render_context(browser, scale: int, width: int = None):
+    """新建用于渲染的 BrowserContext，并挂载请求路由（本地静态资源 + 外部请求拦截）。"""
+    context = await browser.new_context(
+        device_scale_factor=scale, viewport=_viewport_for_width(width)
+    )
+    await context.route("**/*", _route_render_request)
+    return context
+
 
-    # 2. 改进的 HTML 模板，为 body 样式增加了一个占位符 {width_style}
-    html_template = """
+@functools.lru_cache(maxsize=512)
+def _md_to_html(md_text: str) -> Tuple[str, tuple]:
+    """
+    将 Markdown 转换为 HTML 片段；相同正文（如重试渲染）直接复用解析结果。
+
+    公式先替换为占位符再交给 Markdown 解析器，避免其中的 _、* 等被当作强调语法，
+    由 _fill_math 在解析后还原。
+
+    :return: (含公式占位符的 HTML 片段, 公式元组 ((tex, 是否独立公式), ...))
+    """
+    formulas = []
+
+    def _stash(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        display = match.group(2) is not None
+        formulas.append((match.group(2) if display else match.group(3), display))
+        return f"MD2IMGMATH{len(formulas) - 1}X"
+
+    protected = _MATH_RE.sub(_stash, md_text) if "$" in md_text else md_text
+    return _markdown_to_html(protected), tuple(formulas)
+
+
+# mistune 解析器：模块加载时创建一次。与 mistune.html 相同的插件与原始 HTML 处理，
+# 另加 url 插件自动链接裸 URL，与 cmarkgfm 的 autolink 扩展保持一致
+_MISTUNE_PLUGINS = ["strikethrough", "footnotes", "table", "url"]
+try:
+    # mistune 3 的 speedup 插件（mistune.html 默认启用）加快段落与行内文本解析；
+    # 它会检查 url 插件是否已注册，因此须放在 url 之后
+    import mistune.plugins.speedup  # noqa: F401
+    _MISTUNE_PLUGINS.append("speedup")
+except ImportError:
+    pass
+_MISTUNE_MARKDOWN = mistune.create_markdown(escape=False, plugins=_MISTUNE_PLUGINS)
+
+
+def _markdown_to_html(md_text: str) -> str:
+    """Markdown -> HTML：优先使用 cmarkgfm，未安装时回退到 mistune。"""
+    if cmarkgfm is not None:
+        # 与 mistune 解析器一致：支持表格、删除线、脚注与自动链接，保留原始 HTML
+        return cmarkgfm.markdown_to_html_with_extensions(
+            md_text,
+            options=CmarkOptions.CMARK_OPT_UNSAFE | CmarkOptions.CMARK_OPT_FOOTNOTES,
+            extensions=["table", "strikethrough", "autolink"],
+        )
+    return _MISTUNE_MARKDOWN(md_text)
+
+
+def _fill_math(html_content: str, formulas: tuple, rendered: List[str] = None) -> str:
+    """
+    把公式占位符还原到 HTML 中。
+
+    :param rendered: 与 formulas 一一对应的预排版 HTML；为 None 时还原为待页面内 KaTeX 排版的节点。
+    """
+    if not formulas:
+        return html_content
+
+    def _restore(match):
+        index = int(match.group(1))
+        if index >= len(formulas):
+            # 正文中原本就有形如占位符的文本，原样保留
+            return match.group(0)
+        if rendered is not None:
+            return rendered[index]
+        tex, display = formulas[index]
+        css_class = "md2img-math md2img-display" if display else "md2img-math"
+        return f'<span class="{css_class}">{html.escape(tex)}</span>'
+
+    return _MATH_PLACEHOLDER_RE.sub(_restore, html_content)
+
+
+# 页面模板：__WIDTH_STYLE__ 注入 body 宽度样式，__MATH_SCRIPTS__ 按需注入 KaTeX 资源，__CONTENT__ 为正文。
+# 占位符用 str.replace 填充，CSS 中的花括号无需转义
+HTML_TEMPLATE = """
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <title>Markdown Render</title>
         <style>
-            body {{
-                {width_style} /* 宽度样式将在这里注入 */
+            body {
+                __WIDTH_STYLE__ /* 宽度样式将在这里注入 */
                 font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Helvetica, Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji";
                 padding: 25px;
                 display: inline-block; /* 让截图尺寸自适应内容 */
@@ -60,102 +480,924 @@ async def markdown_to_image_playwright(
                 -webkit-font-smoothing: antialiased;
                 -moz-osx-font-smoothing: grayscale;
                 text-rendering: optimizeLegibility;
-            }}
+            }
             /* 为代码块添加一些样式 */
-            pre {{
+            pre {
                 background-color: #f6f8fa;
                 border-radius: 6px;
                 padding: 16px;
                 overflow: auto;
                 font-size: 85%;
                 line-height: 1.45;
-            }}
-            code {{
+            }
+            code {
                 font-family: "SFMono-Regular", Consolas, "Liberation Mono", Menlo, monospace;
-            }}
+            }
         </style>
-        <script type="text/javascript" async
-            src="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.7/MathJax.js?config=TeX-MML-AM_CHTML">
-        </script>
-        <script type="text/x-mathjax-config">
-            MathJax.Hub.Config({{
-                tex2jax: {{
-                    inlineMath: [['$','$']],
-                    displayMath: [['$$','$$']],
-                }},
-                "HTML-CSS": {{
-                    scale: 100,
-                    linebreaks: {{ automatic: true }}
-                }},
-                SVG: {{ linebreaks: {{ automatic: true }} }}
-            }});
-        </script>
+        __MATH_SCRIPTS__
     </head>
     <body>
-        {content}
+        __CONTENT__
     </body>
     </html>
+"""
+
+
+@functools.lru_cache(maxsize=8)
+def _html_shell(width: int = None, math_mode: str = None) -> Tuple[str, str]:
     """
+    预先填好宽度样式与脚本，把模板切分为正文前后两段。
 
-    # 3. 将 Markdown 转换为 HTML
-    html_content = mistune.html(md_text)
+    宽度与公式模式的组合很少，缓存后每次渲染只需做一次字符串拼接，
+    不必每次重新填充整段模板。
 
-    # 4. 填充 HTML 模板，同时传入内容和宽度样式
-    full_html = html_template.format(
-        content=html_content, width_style=width_style)
+    :param math_mode: None 表示无公式；"css" 表示公式已预排版，只需样式表；
+        "js" 表示需要在页面内排版。
 
-    # 5. 使用 Playwright 进行截图
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
-        context = await browser.new_context(
-            device_scale_factor=scale
-        )
-        page = await context.new_page()
+    :return: (正文之前的 HTML, 正文之后的 HTML)
+    """
+    # 根据是否提供了 width 参数，动态生成 body 的宽度样式
+    width_style = ""
+    if width:
+        # box-sizing: border-box 可确保 padding 包含在设定的 width 内
+        width_style = f"width: {width}px; box-sizing: border-box;"
 
-        await page.set_content(full_html, wait_until="networkidle")
+    math_scripts = {
+        None: "",
+        "css": KATEX_CSS,
+        "js": KATEX_CSS + KATEX_SCRIPTS,
+    }[math_mode]
+    head, tail = HTML_TEMPLATE.split("__CONTENT__")
+    head = head.replace("__WIDTH_STYLE__", width_style).replace("__MATH_SCRIPTS__", math_scripts)
+    return head, tail
+
+
+def _build_html(md_text: str, width: int = None) -> Tuple[str, bool]:
+    """
+    将 Markdown 转换为完整的 HTML 页面。
+
+    :param md_text: Markdown 格式的字符串。
+    :param width: 图片内容的固定宽度（单位：像素）。如果为 None，则宽度自适应内容。
+    :return: (完整 HTML, 是否包含公式)
+    """
+    return _assemble_html(*_md_to_html(md_text), width)
+
+
+def _assemble_html(html_content: str, formulas: tuple, width: int = None, rendered: List[str] = None) -> Tuple[str, bool]:
+    """
+    由 _md_to_html 的结果拼装完整 HTML 页面。
+
+    :param rendered: 预排版的公式 HTML（见 _fill_math）；为 None 时在页面内排版。
+    :return: (完整 HTML, 是否包含公式)
+    """
+    if not formulas:
+        math_mode = None
+    elif rendered is not None:
+        math_mode = "css"
+    else:
+        math_mode = "js"
+    head, tail = _html_shell(width, math_mode)
+    return head + _fill_math(html_content, formulas, rendered) + tail, bool(formulas)
+
+
+# 在当前页面中直接重写文档而不触发导航；等待 load（脚本、样式、图片加载完毕）后返回。
+# document.open() 会清除此前注册的监听器，因此 load 监听器在写入之后再注册
+_WRITE_DOCUMENT_JS = """
+(html) => {
+    document.open();
+    document.write(html);
+    document.close();
+    if (document.readyState === "complete") {
+        return;
+    }
+    return new Promise((resolve) => window.addEventListener("load", resolve, { once: true }));
+}
+"""
+
+# 页面载入（含外部脚本/图片）的最长等待时间（秒），与 Playwright 默认超时一致
+PAGE_LOAD_TIMEOUT = 30
+
+
+async def _load_html(page, full_html: str):
+    """把 HTML 写入页面并等待 load，复用同一个 about:blank 文档，省去 set_content 的导航开销。"""
+    await asyncio.wait_for(
+        page.evaluate(_WRITE_DOCUMENT_JS, full_html), timeout=PAGE_LOAD_TIMEOUT
+    )
+
+
+# body 为 inline-block，其包围盒即内容区域（不含默认 margin）
+_BODY_CLIP_JS = """
+() => {
+    const r = document.body.getBoundingClientRect();
+    return {
+        x: r.left + window.scrollX,
+        y: r.top + window.scrollY,
+        width: Math.ceil(r.width),
+        height: Math.ceil(r.height)
+    };
+}
+"""
+
+
+def _write_file_atomic(path: str, data: bytes):
+    """
+    原子地写入文件：先一次性写入同目录下的临时文件，再 os.replace 到目标路径。
+    并发渲染同一内容或读取缓存时，不会看到写了一半的图片。
+    """
+    directory = os.path.dirname(path) or "."
+    # 缓存分片子目录按需创建
+    os.makedirs(directory, exist_ok=True)
+    # 不用 tempfile.mkstemp：它以 0600 创建文件，os.replace 后缓存图片只有本用户可读，
+    # 以文件路径读取图片的适配器（如另一个容器中的 NapCat）会读取失败。
+    # 按 0666 创建、由 umask 裁剪，与普通 open() 写出的文件权限一致
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.urandom(6).hex()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _file_base64(path: str) -> str:
+    """读取文件并编码为 base64：mmap 后直接交给 b64encode，省去先读成 bytes 的一次拷贝。"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return base64.b64encode(mm).decode("ascii")
+
+
+def _screenshot_options(output_image_path: str) -> dict:
+    """根据输出文件扩展名选择截图格式：.jpg/.jpeg 输出 JPEG，其余输出 PNG。"""
+    if output_image_path.lower().endswith((".jpg", ".jpeg")):
+        return {"type": "jpeg", "quality": JPEG_QUALITY}
+    return {"type": "png"}
+
+
+async def _screenshot_page(page, full_html: str, output_image_path: str, with_math: bool = True):
+    """
+    在给定页面中载入 HTML 并对 <body> 截图。
+
+    :param page: 用于渲染的 Playwright Page，缩放因子由其所属 BrowserContext 决定。
+    :param full_html: 完整的 HTML 页面。
+    :param output_image_path: 图片输出路径。
+    :param with_math: 页面是否注入了 KaTeX，需要等待公式字体加载完成。
+    """
+    # load 会等待 KaTeX 脚本/样式以及正文中的图片；KaTeX 在此之前已同步完成排版
+    await _load_html(page, full_html)
 
-        # 更稳健地等待 MathJax 渲染完成
+    if with_math:
+        # KaTeX 字体按需加载，不计入 load 事件，需单独等待以免截到回退字体
         try:
-            await page.evaluate("MathJax.Hub.Queue(['Typeset', MathJax.Hub])")
-            await page.wait_for_function("typeof MathJax.Hub.Queue.running === 'undefined' || MathJax.Hub.Queue.running === 0")
+            await asyncio.wait_for(
+                page.evaluate("document.fonts.ready.then(() => true)"), timeout=SCREENSHOT_TIMEOUT
+            )
         except Exception as e:
-            print(f"等待 MathJax 时出错 (可能是页面加载太快): {e}")
+            logger.warning(f"等待公式字体时出错: {e}")
+
+    # 一次 evaluate 量出 body 的区域，直接按区域截图，省去元素句柄查询及其二次测量
+    clip = await page.evaluate(_BODY_CLIP_JS)
+    # full_page=True 时 clip 相对整页计算，内容超出视口高度也能完整截取。
+    # 取回字节后自行原子写入，避免缓存中出现写了一半的图片
+    image_bytes = await page.screenshot(
+        clip=clip, full_page=True, timeout=SCREENSHOT_TIMEOUT * 1000,
+        **_screenshot_options(output_image_path)
+    )
+    await asyncio.get_running_loop().run_in_executor(
+        None, _write_file_atomic, output_image_path, image_bytes
+    )
+    logger.debug(f"图片已保存到: {output_image_path}")
+
+
+async def _screenshot_html(browser, full_html: str, output_image_path: str, scale: int = 2, with_math: bool = True, width: int = None):
+    """
+    在已启动的浏览器中新建一个 BrowserContext 渲染 HTML 并截图。
 
-        element_handle = await page.query_selector('body')
-        if not element_handle:
-            raise Exception("无法找到 <body> 元素进行截图。")
+    :param browser: 已启动的 Playwright Browser 实例。
+    :param full_html: 完整的 HTML 页面。
+    :param output_image_path: 图片输出路径。
+    :param scale: 渲染的缩放因子。
+    :param with_math: 页面是否注入了 KaTeX。
+    :param width: 正文固定宽度，用于确定视口大小。
+    """
+    context = await _new_render_context(browser, scale, width)
+    try:
+        page = await context.new_page()
+        await _screenshot_page(page, full_html, output_image_path, with_math)
+    finally:
+        await context.close()
 
-        await element_handle.screenshot(path=output_image_path)
-        await browser.close()
-        print(f"图片已保存到: {output_image_path}")
 
+async def markdown_to_image_playwright(
+    md_text: str,
+    output_image_path: str,
+    scale: int = 2,
+    width: int = None,
+    browser=None
+):
+    """
+    使用 Playwright 将包含 LaTeX 的 Markdown 转换为图片。
 
+    :param md_text: Markdown 格式的字符串。
+    :param output_image_path: 图片输出路径。
+    :param scale: 渲染的缩放因子。大于 1 的值可以有效提升清晰度和抗锯齿效果。
+    :param width: 图片内容的固定宽度（单位：像素）。如果为 None，则宽度自适应内容。
+    :param browser: 复用的常驻 Browser 实例。为 None 时临时启动一个浏览器（仅适合本地调试）。
+    """
+    # 解析与拼装都是同步的 CPU 工作，放到默认线程池执行，不阻塞事件循环
+    full_html, with_math = await asyncio.get_running_loop().run_in_executor(
+        None, _build_html, md_text, width
+    )
 
-# 仅用于本地调试（不会影响插件运行）
-markdown_string = """
-# Playwright 渲染测试
+    if browser is not None:
+        await _screenshot_html(browser, full_html, output_image_path, scale, with_math, width)
+        return
 
-这是一个宽度被设置为 600px 的示例。当文本内容足够长时，它会自动换行以适应设定的宽度。
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(args=BROWSER_LAUNCH_ARGS)
+        try:
+            await _screenshot_html(browser, full_html, output_image_path, scale, with_math, width)
+        finally:
+            await browser.close()
 
-行内公式 $a^2 + b^2 = c^2$。
 
-独立公式：
-$$
-\\int_0^\\infty e^{-x^2} dx = \\frac{\\sqrt{\\pi}}{2}
-$$
 
-以及一段 C++ 代码:
-```cpp
-#include <iostream>
+# 简单正文快速路径：只含标题、段落与列表的纯文本，用 Pillow 直接绘制，跳过浏览器。
+# 出现以下任一字符即交给浏览器渲染，保证快速路径不会丢失任何格式
+_SIMPLE_MD_BLOCKERS = frozenset("`$|*_~<>[]\\&")
+# 简单正文中允许的块级标记：标题与（不嵌套的）无序列表
+_SIMPLE_HEADING_RE = re.compile(r"(#{1,6})\s+(.*)")
+_SIMPLE_BULLET_RE = re.compile(r"[-+]\s+(.*)")
+# 快速路径不处理的行：缩进（嵌套列表/缩进代码）、有序列表、分割线与 Setext 标题下划线、空标题
+_SIMPLE_REJECT_LINE_RE = re.compile(
+    r"^(?:[ \t]|\d+[.)](?:\s|$)|[-=+]+[ \t]*$|#{1,6}[ \t]*$)", re.MULTILINE
+)
+# ATX 标题行（需要粗体字体才能走快速路径）及其末尾可选的闭合 #
+_SIMPLE_HEADING_LINE_RE = re.compile(r"^#{1,6}[ \t]", re.MULTILINE)
+_SIMPLE_HEADING_CLOSE_RE = re.compile(r"\s+#+$")
+# 快速路径可绘制的字符：无需字形组合/双向排版的文字（拉丁、希腊、西里尔、常用符号、中日韩）
+_SIMPLE_TEXT_RE = re.compile(
+    "[\n\r\u0020-\u024f\u0370-\u03ff\u0400-\u04ff\u2000-\u2bff"
+    "\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]*"
+)
+# 快速路径处理的正文长度上限，更长的内容交给浏览器
+_SIMPLE_MAX_LEN = 2000
+
+# 排版参数（CSS 像素），取自 HTML 模板与 Chromium 默认样式表
+_SIMPLE_FONT_SIZE = 16
+_SIMPLE_PADDING = 25
+# 段落与列表的上下外边距（1em），列表的左内边距
+_SIMPLE_BLOCK_MARGIN = 16
+_SIMPLE_LIST_INDENT = 40
+# 各级标题：(字号相对正文的倍数, 上下外边距相对标题字号的倍数)
+_SIMPLE_HEADINGS = {
+    1: (2.0, 0.67), 2: (1.5, 0.83), 3: (1.17, 1.0), 4: (1.0, 1.33), 5: (0.83, 1.67), 6: (0.67, 2.33),
+}
 
-int main() {
-    std::cout << "Hello, C++!" << std::endl;
-    return 0;
+# 快速路径所用字体：优先 assets/fonts/ 下的字体，其次常见系统中文字体。
+# 值为同一字体的粗体文件（标题使用），没有粗体时含标题的正文交给浏览器
+_SIMPLE_FONT_CANDIDATES = {
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc": "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc": "/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc": "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc": None,
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc": None,
+    "/System/Library/Fonts/PingFang.ttc": None,
+    "C:/Windows/Fonts/msyh.ttc": "C:/Windows/Fonts/msyhbd.ttc",
 }
-```
-"""
 
 
+def _is_simple_markdown(md_text: str) -> bool:
+    """
+    正文能否由 Pillow 快速路径绘制：只含标题、段落和不嵌套的无序列表（无代码、公式、表格、图片、
+    链接、强调、HTML、实体、emoji），字体能绘制其中所有字符，有标题时还需找到对应的粗体。
+    版式按浏览器的默认样式排布，但字体度量与抗锯齿不同，结果与浏览器渲染相近而非逐像素一致。
+    """
+    if (
+        len(md_text) > _SIMPLE_MAX_LEN
+        or not _SIMPLE_MD_BLOCKERS.isdisjoint(md_text)
+        or _SIMPLE_REJECT_LINE_RE.search(md_text)
+        # emoji 需要浏览器的彩色字体回退，阿拉伯文等需要字形组合
+        or not _SIMPLE_TEXT_RE.fullmatch(md_text)
+        or _simple_font_path() is None
+        or (_simple_font_path(bold=True) is None and _SIMPLE_HEADING_LINE_RE.search(md_text))
+    ):
+        return False
+    return all(_simple_font_has_glyph(ch) for ch in set(md_text) if not ch.isspace())
+
+
+# 无格式短句：不超过该长度的单行 <md> 内容若不含任何 Markdown 语法，直接以纯文本发送
+_TRIVIAL_TEXT_MAX_LEN = 200
+# 单行内容中会改变渲染结果的行首标记：列表项与分割线
+_TRIVIAL_LINE_START_RE = re.compile(r"([-+]|\d+[.)])(\s|$)|-{3,}\s*$")
+
+
+def _is_trivial_text(md_text: str) -> bool:
+    """<md> 内容是否只是一句无格式短文本：渲染为图片与纯文本无异，无需启动渲染。"""
+    return (
+        len(md_text) <= _TRIVIAL_TEXT_MAX_LEN
+        and "\n" not in md_text
+        and "#" not in md_text
+        and "&" not in md_text
+        and _SIMPLE_MD_BLOCKERS.isdisjoint(md_text)
+        and not _TRIVIAL_LINE_START_RE.match(md_text)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _simple_font_path(bold: bool = False):
+    """
+    查找快速路径可用的字体文件；未安装 Pillow 或找不到字体时返回 None。
+
+    :param bold: 查找标题所用的粗体。assets/fonts/ 下文件名含 bold 的字体视为粗体。
+    """
+    if PILImage is None:
+        return None
+    fonts_dir = os.path.join(ASSETS_DIR, "fonts")
+    if os.path.isdir(fonts_dir):
+        fonts = [
+            name for name in sorted(os.listdir(fonts_dir))
+            if name.lower().endswith((".ttf", ".otf", ".ttc"))
+        ]
+        regular = [name for name in fonts if "bold" not in name.lower()]
+        if regular:
+            picked = [name for name in fonts if "bold" in name.lower()] if bold else regular
+            return os.path.join(fonts_dir, picked[0]) if picked else None
+    for path, bold_path in _SIMPLE_FONT_CANDIDATES.items():
+        if os.path.isfile(path):
+            if not bold:
+                return path
+            return bold_path if bold_path and os.path.isfile(bold_path) else None
+    return None
+
+
+@functools.lru_cache(maxsize=16)
+def _simple_font(size: int, bold: bool = False):
+    return ImageFont.truetype(_simple_font_path(bold), size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _simple_font_has_glyph(ch: str) -> bool:
+    """字体是否含有该字符的字形：缺字时 FreeType 绘制 .notdef，与非字符 U+FFFF 的结果相同。"""
+    font = _simple_font(_SIMPLE_FONT_SIZE)
+    notdef = font.getmask("\uffff")
+    mask = font.getmask(ch)
+    return mask.size != notdef.size or bytes(mask) != bytes(notdef)
+
+
+def _wrap_line(text: str, font, max_width: float) -> List[str]:
+    """
+    按像素宽度折行：优先在空格处断开，中文等无空格文本逐字断开。
+    逐字累加字宽（同一字符只测量一次），整行只需线性扫描。
+    """
+    advances = {}
+    lines = []
+    start = 0
+    index = 0
+    line_width = 0.0
+    last_space = -1
+    while index < len(text):
+        ch = text[index]
+        advance = advances.get(ch)
+        if advance is None:
+            advance = advances[ch] = font.getlength(ch)
+        if line_width + advance > max_width and index > start:
+            # 放不下：退回到本行最后一个空格处断开，没有空格则在当前字符前断开
+            end = last_space if last_space > start else index
+            lines.append(text[start:end].rstrip())
+            start = end
+            while start < len(text) and text[start] == " ":
+                start += 1
+            index, line_width, last_space = start, 0.0, -1
+            continue
+        if ch == " ":
+            last_space = index
+        line_width += advance
+        index += 1
+    tail = text[start:].rstrip()
+    if tail:
+        lines.append(tail)
+    return lines
+
+
+def _render_simple_text(md_text: str, output_image_path: str, scale: int, width: int):
+    """
+    用 Pillow 直接把简单 Markdown（标题/段落/列表）绘制为图片。
+
+    块的外边距、列表缩进与行高（normal，即字体的 ascent + descent）按浏览器的默认样式计算，
+    相邻块的外边距与浏览器一样折叠为较大者。调用方需先确认 _is_simple_markdown(md_text)。
+    """
+    padding = _SIMPLE_PADDING * scale
+    content_width = (width - 2 * _SIMPLE_PADDING) * scale
+    base_size = _SIMPLE_FONT_SIZE * scale
+    block_margin = _SIMPLE_BLOCK_MARGIN * scale
+    list_indent = _SIMPLE_LIST_INDENT * scale
+
+    # 先按 Markdown 规则划分块：[类型("h"/"p"/"li"), 标题级别, 文本行, 所属列表序号]。
+    # 软换行与浏览器一致地并为一个空格，行尾两个空格的硬换行另起一行
+    blocks = []
+    loose_lists = []  # 各列表是否为松散列表（项之间有空行，每项带段落外边距）
+    list_index = None
+    continuable = False
+    blank_before = False
+    hard_break = False
+    for raw_line in md_text.splitlines():
+        # 连续空白与浏览器一致地折叠为一个空格
+        line = " ".join(raw_line.split())
+        if not line:
+            continuable = False
+            blank_before = True
+            continue
+        heading = _SIMPLE_HEADING_RE.fullmatch(line)
+        bullet = _SIMPLE_BULLET_RE.fullmatch(line)
+        if heading:
+            title = _SIMPLE_HEADING_CLOSE_RE.sub("", heading.group(2))
+            blocks.append(["h", len(heading.group(1)), [title], None])
+            list_index = None
+            continuable = False
+        elif bullet:
+            if list_index is None:
+                list_index = len(loose_lists)
+                loose_lists.append(False)
+            elif blank_before:
+                loose_lists[list_index] = True
+            blocks.append(["li", 0, [bullet.group(1)], list_index])
+            continuable = True
+        elif continuable:
+            lines = blocks[-1][2]
+            if hard_break:
+                lines.append(line)
+            else:
+                lines[-1] += " " + line
+        else:
+            blocks.append(["p", 0, [line], None])
+            list_index = None
+            continuable = True
+        hard_break = raw_line.endswith("  ")
+        blank_before = False
+
+    # 再排版为 (字体, 缩进, 文本, 是否列表项首行) 行列表及每块的 (上外边距, 下外边距)
+    laid_out = []
+    for index, (kind, level, lines, owner) in enumerate(blocks):
+        font, indent = _simple_font(base_size), 0
+        if kind == "h":
+            size_ratio, margin_ratio = _SIMPLE_HEADINGS[level]
+            size = round(base_size * size_ratio)
+            font = _simple_font(size, bold=True)
+            margins = (round(size * margin_ratio),) * 2
+        elif kind == "li":
+            indent = list_indent
+            first = index == 0 or blocks[index - 1][3] != owner
+            last = index + 1 == len(blocks) or blocks[index + 1][3] != owner
+            loose = loose_lists[owner]
+            margins = (
+                block_margin if first or loose else 0,
+                block_margin if last or loose else 0,
+            )
+        else:
+            margins = (block_margin, block_margin)
+        rows = []
+        for line in lines:
+            rows.extend(_wrap_line(line, font, content_width - indent))
+        laid_out.append((margins, [(font, indent, row, kind == "li" and i == 0) for i, row in enumerate(rows)]))
+
+    # 相邻块的外边距折叠为较大者；首尾块的外边距不与 body 的内边距折叠
+    height = 2 * padding
+    previous_bottom = 0
+    for (top, bottom), rows in laid_out:
+        height += max(previous_bottom, top) + sum(sum(font.getmetrics()) for font, *_ in rows)
+        previous_bottom = bottom
+    height += previous_bottom
+
+    image = PILImage.new("RGB", (width * scale, height), "white")
+    draw = ImageDraw.Draw(image)
+    y = padding
+    previous_bottom = 0
+    for (top, bottom), rows in laid_out:
+        y += max(previous_bottom, top)
+        for font, indent, text, marker in rows:
+            x = padding + indent
+            if marker:
+                # 列表符号位于内容左侧（list-style-position: outside）
+                draw.text((x - font.getlength("\u2022 "), y), "\u2022", font=font, fill="black")
+            draw.text((x, y), text, font=font, fill="black")
+            y += sum(font.getmetrics())
+        previous_bottom = bottom
+    buffer = io.BytesIO()
+    image.save(buffer, format=_screenshot_options(output_image_path)["type"], quality=JPEG_QUALITY)
+    _write_file_atomic(output_image_path, buffer.getvalue())
+
+
+# 仅含一个围栏代码块的正文：group(1) 为语言，group(2) 为代码
+_SINGLE_CODE_BLOCK_RE = re.compile(r"```([\w+#.-]*)[ \t]*\n(.*?)\n?```", re.DOTALL)
+
+# 代码图片排版参数（CSS 像素），与 HTML 模板中 pre 的样式大致对应
+_CODE_FONT_NAME = "DejaVu Sans Mono"
+_CODE_FONT_SIZE = 14
+_CODE_PADDING = 16
+
+# 构造 ImageFormatter 时找不到等宽字体（如精简镜像中没有 fontconfig 或字体）后置为 False，
+# 此后代码块不再尝试快速路径，直接交给浏览器
+_code_font_usable = True
+
+
+def _match_single_code_block(md_text: str):
+    """正文恰好是一个 ASCII 代码块时返回 (语言, 代码)，否则返回 None。"""
+    if pygments is None or PILImage is None or not _code_font_usable:
+        return None
+    match = _SINGLE_CODE_BLOCK_RE.fullmatch(md_text)
+    if match is None:
+        return None
+    language, code = match.groups()
+    # 代码内再出现 ``` 说明其实是多个代码块；非 ASCII 字符（如中文注释）等宽字体无法显示
+    if "```" in code or not code.isascii():
+        return None
+    return language, code
+
+
+@functools.lru_cache(maxsize=8)
+def _code_formatter(scale: int, image_format: str):
+    """
+    按 (缩放因子, 图片格式) 缓存 ImageFormatter：构造时 Pygments 会多次调用 fc-list 查找字体。
+    format() 会改写实例状态，复用依赖于代码图片只在单线程的 _prep_executor 中绘制。
+    """
+    return ImageFormatter(
+        font_name=_CODE_FONT_NAME,
+        font_size=_CODE_FONT_SIZE * scale,
+        image_pad=_CODE_PADDING * scale,
+        line_numbers=False,
+        image_format=image_format,
+    )
+
+
+def _render_code_image(language: str, code: str, output_image_path: str, scale: int):
+    """用 Pygments 的 ImageFormatter 把代码高亮后直接绘制为图片。"""
+    global _code_font_usable
+    try:
+        lexer = get_lexer_by_name(language) if language else TextLexer()
+    except ClassNotFound:
+        lexer = TextLexer()
+    try:
+        formatter = _code_formatter(scale, _screenshot_options(output_image_path)["type"])
+    except Exception:
+        # 字体查找失败不会自行恢复，关闭快速路径，避免每个代码块都重复探测后再回退
+        _code_font_usable = False
+        raise
+    image_bytes = pygments.highlight(code, lexer, formatter)
+    _write_file_atomic(output_image_path, image_bytes)
+
+
+class PlaywrightRenderer:
+    """
+    常驻的 Playwright 渲染器：持有 Playwright 驱动、若干 Chromium 实例、预热的 Page 池，
+    以及公式预排版所用的 KaTeX 页面。插件只持有一个实例，所有渲染共享，避免每次冷启动浏览器。
+    """
+
+    def __init__(self, prep_executor: ThreadPoolExecutor):
+        """
+        :param prep_executor: 执行 Markdown 解析等 CPU 工作的线程池，避免阻塞事件循环。
+        """
+        self._prep_executor = prep_executor
+        self._pw = None
+        self._browsers = [None] * BROWSER_POOL_SIZE
+        self._browser_lock = asyncio.Lock()
+        # 各浏览器已完成的渲染次数；达到上限后退役，待其上的 Page 全部归还后关闭
+        self._browser_uses = {}
+        self._retired_browsers = set()
+        # 新建 Page 时轮流分配到各个浏览器
+        self._next_browser = itertools.count()
+        # 预热的 Page 池：(device_scale_factor, 正文宽度) -> asyncio.Queue[Page | None]，
+        # None 为空槽位（原 Page 已失效），借出时再补建，保证池中槽位总数不变
+        self._page_pools = {}
+        self._page_pool_lock = asyncio.Lock()
+        # 公式预排版：常驻的 KaTeX 页面 + 按公式缓存的排版结果（LRU）
+        self._math_page = None
+        self._math_page_lock = asyncio.Lock()
+        # 退役浏览器上的公式页面由后台任务在锁内关闭，保留引用以免任务被回收
+        self._math_page_release = None
+        # 公式页面最近一次失败后，允许重试的时间（time.monotonic()）
+        self._math_retry_at = 0.0
+        self._formula_cache = OrderedDict()
+
+    def _browsers_healthy(self) -> bool:
+        """已启动的浏览器是否都仍然连接（未启动的槽位不算异常）。"""
+        return all(b is None or b.is_connected() for b in self._browsers)
+
+    async def _get_browser(self, index: int = 0):
+        """获取第 index 个常驻浏览器；尚未启动或已断开时（重新）启动。"""
+        async with self._browser_lock:
+            browser = self._browsers[index]
+            if browser is not None and browser.is_connected():
+                return browser
+            if self._pw is None:
+                self._pw = await async_playwright().start()
+            browser = await self._pw.chromium.launch(args=BROWSER_LAUNCH_ARGS)
+            self._browsers[index] = browser
+            return browser
+
+    async def _new_pooled_page(self, scale: int, width: int = None):
+        """在常驻浏览器上（轮流选择）创建一个独占 BrowserContext 的 Page。"""
+        index = next(self._next_browser) % BROWSER_POOL_SIZE
+        browser = await self._get_browser(index)
+        context = await _new_render_context(browser, scale, width)
+        return await context.new_page()
+
+    async def _get_page_pool(self, scale: int, width: int = None) -> asyncio.Queue:
+        """获取（必要时创建并预热）指定缩放因子与宽度的 Page 池。"""
+        async with self._page_pool_lock:
+            if not self._browsers_healthy():
+                # 有浏览器已崩溃/断开：只替换其上的 Page，其余浏览器上的 Page 照常使用
+                self._drop_disconnected_browsers()
+            pool = self._page_pools.get((scale, width))
+            if pool is None:
+                # 各 Page 相互独立，并发创建，省去逐个等待浏览器往返
+                pages = await asyncio.gather(
+                    *(self._new_pooled_page(scale, width) for _ in range(PAGE_POOL_SIZE)),
+                    return_exceptions=True,
+                )
+                errors = [p for p in pages if isinstance(p, BaseException)]
+                if errors:
+                    # 部分创建失败：关闭已创建的页面，避免泄漏 BrowserContext
+                    for page in pages:
+                        if not isinstance(page, BaseException):
+                            try:
+                                await page.context.close()
+                            except Exception:
+                                pass
+                    raise errors[0]
+                pool = asyncio.Queue(maxsize=PAGE_POOL_SIZE)
+                for page in pages:
+                    pool.put_nowait(page)
+                self._page_pools[(scale, width)] = pool
+            return pool
+
+    def _drop_disconnected_browsers(self):
+        """释放已断开浏览器的槽位，并把各池中位于其上的空闲 Page 换成空槽位。"""
+        for index, browser in enumerate(self._browsers):
+            if browser is not None and not browser.is_connected():
+                # 下次取该槽位的浏览器时会重新启动
+                self._browsers[index] = None
+                self._browser_uses.pop(browser, None)
+        for pool in self._page_pools.values():
+            pages = []
+            while not pool.empty():
+                pages.append(pool.get_nowait())
+            for page in pages:
+                # 浏览器断开时其上的 BrowserContext 已随之销毁，无需再关闭
+                if page is not None and not page.context.browser.is_connected():
+                    page = None
+                pool.put_nowait(page)
+        # 借出中的 Page 归还时重置失败，同样会被换成空槽位
+
+    async def chromium_installed(self) -> bool:
+        """Playwright 对应版本的 Chromium 可执行文件是否已存在（由 Playwright 给出期望路径）。"""
+        async with self._browser_lock:
+            if self._pw is None:
+                self._pw = await async_playwright().start()
+            return os.path.isfile(self._pw.chromium.executable_path)
+
+    async def warm_up(self, scale: int, width: int = None):
+        """
+        启动浏览器并预热指定缩放因子与宽度的 Page 池。
+
+        每个 Page 先做一次丢弃结果的渲染，并提前加载 KaTeX 页面，把 V8 编译、字体加载等
+        首次开销挪到启动阶段，首个真实请求不再为此等待。预渲染失败只记录警告。
+        """
+        pool = await self._get_page_pool(scale, width)
+        warm_html, _ = _assemble_html("<p>md2img</p>", (), width)
+        slots = []
+        while not pool.empty():
+            slots.append(pool.get_nowait())
+        pages = [page for page in slots if page is not None]
+        try:
+            # return_exceptions：某一项失败时仍等待其余页面预渲染结束，再把页面放回池中
+            math_result, *results = await asyncio.wait_for(
+                asyncio.gather(
+                    self._get_math_page(),
+                    *(self._warm_page(page, warm_html) for page in pages),
+                    return_exceptions=True,
+                ),
+                timeout=WARM_UP_TIMEOUT,
+            )
+            if isinstance(math_result, BaseException):
+                self._math_retry_at = time.monotonic() + MATH_PAGE_RETRY_INTERVAL
+                logger.warning(f"公式页面预加载失败，含公式的内容将在渲染页面内排版: {math_result}")
+            for result in results:
+                if isinstance(result, BaseException):
+                    logger.warning(f"预渲染失败，首次渲染可能较慢: {result}")
+                    break
+        except Exception as e:
+            logger.warning(f"预渲染失败，首次渲染可能较慢: {e}")
+        finally:
+            for page in slots:
+                pool.put_nowait(page)
+
+    @staticmethod
+    async def _warm_page(page, html: str):
+        """在页面中渲染一次 HTML 并截图（结果丢弃），然后清空文档。"""
+        await _load_html(page, html)
+        clip = await page.evaluate(_BODY_CLIP_JS)
+        await page.screenshot(clip=clip, full_page=True, type="jpeg", quality=JPEG_QUALITY)
+        await _load_html(page, "<html></html>")
+
+    async def render(self, md_text: str, output_path: str, scale: int, width: int):
+        """从 Page 池借出一个预热页面完成渲染，结束后重置并归还。"""
+        # 先在工作线程中解析 Markdown 并预排版公式，再借出页面，避免准备期间白占一个 Page
+        loop = asyncio.get_running_loop()
+        html_content, formulas = await loop.run_in_executor(
+            self._prep_executor, _md_to_html, md_text
+        )
+        if formulas:
+            rendered = await self._typeset_formulas(formulas)
+            # 还原公式需要再扫描一遍整段 HTML，同样放到工作线程
+            full_html, with_math = await loop.run_in_executor(
+                self._prep_executor, _assemble_html, html_content, formulas, width, rendered
+            )
+        else:
+            # 无公式时只是拼接缓存的页面骨架，直接在事件循环中完成
+            full_html, with_math = _assemble_html(html_content, formulas, width)
+        pool = await self._get_page_pool(scale, width)
+        page = await pool.get()
+        if page is None:
+            # 空槽位：原 Page 已失效，在此补建；失败时归还空槽位，下次借出时再试
+            try:
+                page = await self._new_pooled_page(scale, width)
+            except BaseException:
+                pool.put_nowait(None)
+                raise
+        recycled = None
+        try:
+            await _screenshot_page(page, full_html, output_path, with_math)
+        finally:
+            try:
+                recycled = await self._recycle_page(page)
+            finally:
+                # 无论如何都归还一个槽位，避免池中槽位越来越少直至借出时永远等待
+                pool.put_nowait(recycled)
+
+    async def _recycle_page(self, page):
+        """
+        渲染结束后重置 Page 以便放回池中。
+
+        :return: 可继续使用的 Page；页面已损坏或所在浏览器已退役时将其关闭并返回 None（空槽位）。
+        """
+        try:
+            # 清空文档释放上一次渲染的内容，同时检验页面是否仍然可用
+            await _load_html(page, "<html></html>")
+        except Exception:
+            # 页面已损坏（崩溃/浏览器断开）
+            await self._discard_page(page)
+            return None
+        if self._record_use(page):
+            # 所在浏览器已退役：下次借出时在新浏览器上补建
+            await self._discard_page(page)
+            return None
+        return page
+
+    def _record_use(self, page) -> bool:
+        """
+        记录一次渲染；所在浏览器达到 BROWSER_RECYCLE_AFTER 次后将其退役。
+
+        :return: 该 Page 所在的浏览器是否已退役（Page 不应再放回池中）。
+        """
+        browser = page.context.browser
+        if browser not in self._browsers:
+            return True
+        uses = self._browser_uses.get(browser, 0) + 1
+        if uses < BROWSER_RECYCLE_AFTER:
+            self._browser_uses[browser] = uses
+            return False
+        # 让出槽位，下次取浏览器时会启动新的实例
+        self._browsers[self._browsers.index(browser)] = None
+        self._browser_uses.pop(browser, None)
+        self._retired_browsers.add(browser)
+        return True
+
+    async def _discard_page(self, page):
+        """关闭 Page 所在的 BrowserContext；退役浏览器上已无其他 Context 时一并关闭。"""
+        browser = page.context.browser
+        try:
+            await page.context.close()
+        except Exception:
+            pass
+        math_page = self._math_page
+        if (
+            browser in self._retired_browsers
+            and math_page is not None
+            and browser.contexts == [math_page.context]
+        ):
+            # 退役浏览器上只剩公式页面：等正在进行的排版结束后再丢弃，下次排版时在新浏览器上重建。
+            # 本方法可能在持有 _math_page_lock 时被调用，因此放到单独的任务中获取锁
+            self._math_page_release = asyncio.ensure_future(self._release_math_page(math_page))
+            return
+        if browser in self._retired_browsers and not browser.contexts:
+            self._retired_browsers.discard(browser)
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.warning(f"关闭退役的 Playwright 浏览器失败: {e}")
+
+    async def _release_math_page(self, math_page):
+        """在 _math_page_lock 下丢弃公式页面，不打断正在该页面上进行的排版。"""
+        async with self._math_page_lock:
+            if self._math_page is math_page:
+                self._math_page = None
+                await self._discard_page(math_page)
+
+    async def _get_math_page(self):
+        """获取（必要时创建）专用于公式预排版的 KaTeX 页面。"""
+        async with self._math_page_lock:
+            return await self._ensure_math_page()
+
+    async def _ensure_math_page(self):
+        """_get_math_page 的实现，调用方须持有 _math_page_lock。"""
+        if self._math_page is not None and (
+            self._math_page.context.browser not in self._browsers
+        ):
+            # 所在浏览器已退役，迁移到新的浏览器上
+            retired_page, self._math_page = self._math_page, None
+            await self._discard_page(retired_page)
+        if self._math_page is None or self._math_page.is_closed():
+            browser = await self._get_browser(0)
+            context = await _new_render_context(browser, 1)
+            try:
+                page = await context.new_page()
+                await _load_html(page, KATEX_PAGE_HTML)
+                # KaTeX 脚本加载失败不会阻止 load 事件，需确认其确实可用
+                if not await page.evaluate("typeof katex !== 'undefined'"):
+                    raise RuntimeError("KaTeX 未能加载")
+            except Exception:
+                await context.close()
+                raise
+            self._math_page = page
+        return self._math_page
+
+    async def _typeset_formulas(self, formulas: tuple):
+        """
+        在 KaTeX 页面中预排版公式，结果按公式缓存，常见公式（如 $E=mc^2$）只排版一次。
+
+        :return: 与 formulas 一一对应的 HTML 列表；失败时返回 None，由渲染页面自行排版。
+        """
+        rendered = {}
+        for formula in dict.fromkeys(formulas):
+            cached = self._formula_cache.get(formula)
+            if cached is not None:
+                self._formula_cache.move_to_end(formula)
+                rendered[formula] = cached
+        misses = [formula for formula in dict.fromkeys(formulas) if formula not in rendered]
+
+        if misses:
+            if time.monotonic() < self._math_retry_at:
+                return None
+            # 排版期间持有锁：浏览器回收时公式页面要等本次排版结束才会被关闭
+            async with self._math_page_lock:
+                page = None
+                try:
+                    page = await self._ensure_math_page()
+                    outputs = await page.evaluate(
+                        _TYPESET_FORMULAS_JS, [list(formula) for formula in misses]
+                    )
+                except Exception as e:
+                    logger.warning(f"公式预排版失败，改为页面内排版: {e}")
+                    # 关闭失效的公式页面（避免泄漏 BrowserContext），并暂停一段时间再重建
+                    self._math_retry_at = time.monotonic() + MATH_PAGE_RETRY_INTERVAL
+                    if page is not None and self._math_page is page:
+                        self._math_page = None
+                        await self._discard_page(page)
+                    return None
+            for formula, output in zip(misses, outputs):
+                rendered[formula] = output
+                self._formula_cache[formula] = output
+            while len(self._formula_cache) > FORMULA_CACHE_SIZE:
+                self._formula_cache.popitem(last=False)
+
+        return [rendered[formula] for formula in formulas]
+
+    async def close(self):
+        """关闭所有常驻浏览器与 Playwright 驱动。"""
+        async with self._browser_lock:
+            for browser in [*self._browsers, *self._retired_browsers]:
+                if browser is None:
+                    continue
+                try:
+                    await browser.close()
+                except Exception as e:
+                    logger.warning(f"关闭 Playwright 浏览器失败: {e}")
+            self._browsers = [None] * BROWSER_POOL_SIZE
+            self._browser_uses = {}
+            self._retired_browsers = set()
+            self._page_pools = {}
+            self._math_page = None
+            if self._pw is not None:
+                try:
+                    await self._pw.stop()
+                except Exception as e:
+                    logger.warning(f"停止 Playwright 失败: {e}")
+                self._pw = None
+
 
 @register(
     "astrbot_plugin_md2img",
@@ -164,18 +1406,54 @@ int main() {
     "1.0.0",
 )
 class MarkdownConverterPlugin(Star):
-    def __init__(self, context: Context):
+    def __init__(self, context: Context, config: AstrBotConfig = None):
         super().__init__(context)
+        self.config = config or {}
+        # 输出图片格式；渲染路径均按文件扩展名选择编码方式
+        self.image_format = str(self.config.get("image_format", IMAGE_FORMAT)).lower()
+        if self.image_format not in IMAGE_EXTENSIONS:
+            logger.warning(f"不支持的图片格式 {self.image_format}，改用 {IMAGE_FORMAT}")
+            self.image_format = IMAGE_FORMAT
         self.DATA_DIR = os.path.normpath(StarTools.get_data_dir())
         # 创建一个专门用于存放生成图片的缓存目录
         self.IMAGE_CACHE_DIR = os.path.join(self.DATA_DIR, "md2img_cache")
+        # Markdown -> HTML 是纯 Python 的 CPU 工作，放到专用线程执行，避免长文本阻塞机器人的事件循环。
+        # 浏览器侧的排版与截图编码本就在常驻的 Chromium 子进程中完成
+        self._prep_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="md2img-prep"
+        )
+        # 常驻的 Playwright 渲染器，所有渲染共享
+        self._renderer = PlaywrightRenderer(self._prep_executor)
+        # 已确认存在的缓存图片（缓存键 -> 路径，LRU），以及距上次清理以来新渲染的图片数
+        self._cache_index = OrderedDict()
+        # 内存索引命中的图片 -> 最近使用时间：命中时不做系统调用，由下次清理统一写入修改时间
+        self._cache_touched = {}
+        self._cache_max_bytes = int(self.config.get("cache_max_mb", CACHE_MAX_MB)) * 1024 * 1024
+        self._sweeper_task = None
+        # 正在进行的渲染：缓存键 -> Task，相同内容的并发请求共享同一次渲染
+        self._inflight = {}
+        # initialize 完成浏览器安装与预热后置位；在此之前到来的浏览器渲染先等待
+        self._browser_ready = asyncio.Event()
+        # 缓存图片路径 -> base64（LRU）。路径由内容哈希决定，同一路径的图片内容不变
+        self._base64_cache = OrderedDict()
+        self._base64_cache_bytes = 0
 
     async def initialize(self):
         """初始化插件，确保图片缓存目录和 Playwright 浏览器存在 (异步版本)"""
         try:
-            # os.makedirs is synchronous, but it's extremely fast and not a bottleneck.
-            # For a simple, one-off operation like this, it's fine to keep it.
-            os.makedirs(self.IMAGE_CACHE_DIR, exist_ok=True)
+            # 创建缓存目录，并用磁盘上已有的缓存预填内存索引（重启后的热点内容同样无需 stat）。
+            # 两者都是同步的文件系统操作，一并放到工作线程执行，不阻塞事件循环
+            def prepare_cache_dir():
+                os.makedirs(self.IMAGE_CACHE_DIR, exist_ok=True)
+                return _scan_cache_dir(
+                    self.IMAGE_CACHE_DIR, IMAGE_EXTENSIONS[self.image_format], CACHE_INDEX_SIZE
+                )
+
+            for key, path in await asyncio.get_running_loop().run_in_executor(
+                self._prep_executor, prepare_cache_dir
+            ):
+                self._cache_index[key] = path
+            self._sweeper_task = asyncio.create_task(self._cache_sweeper())
 
             logger.info("正在异步检查并安装 Playwright 浏览器依赖...")
             
@@ -189,9 +1467,30 @@ class MarkdownConverterPlugin(Star):
                     stderr=asyncio.subprocess.PIPE
                 )
 
-                # Await the process to complete and capture the output
+                # 逐行读取输出而不是 communicate() 一次性缓存：下载进度输出可达数 MB。
+                # stdout 逐行写入 debug 日志；stderr 只保留最后若干行的原始字节，失败时才解码报错
+                up_to_date = False
+                stderr_tail = collections.deque(maxlen=50)
+
+                async def drain_stdout():
+                    nonlocal up_to_date
+                    async for line in _iter_output_lines(process.stdout):
+                        text = line.decode('utf-8', errors='ignore').rstrip()
+                        if "up to date" in text:
+                            up_to_date = True
+                        if text:
+                            logger.debug(f"(playwright {description}) {text}")
+
+                async def drain_stderr():
+                    async for line in _iter_output_lines(process.stderr):
+                        stderr_tail.append(line)
+
+                # Await the process to complete while streaming its output
                 try:
-                    stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout_sec)
+                    await asyncio.wait_for(
+                        asyncio.gather(drain_stdout(), drain_stderr(), process.wait()),
+                        timeout=timeout_sec,
+                    )
                 except asyncio.TimeoutError:
                     try:
                         process.kill()
@@ -203,32 +1502,50 @@ class MarkdownConverterPlugin(Star):
                 if process.returncode != 0:
                     logger.error(
                         f"自动安装 Playwright {description} 失败，返回码: {process.returncode}")
-                    if stderr:
-                        logger.error(
-                            f"错误输出: \n{stderr.decode('utf-8', errors='ignore')}")
+                    if stderr_tail:
+                        stderr_text = b"".join(stderr_tail).decode('utf-8', errors='replace')
+                        logger.error(f"错误输出: \n{stderr_text.rstrip()}")
                     return False
                 else:
-                    output = stdout.decode('utf-8', errors='ignore')
-                    # Only log if there's meaningful output (e.g., not just "up to date")
-                    if "up to date" not in output:
-                        logger.info(
-                            f"Playwright {description} 安装/更新完成。\n{output}")
+                    if not up_to_date:
+                        logger.info(f"Playwright {description} 安装/更新完成。")
                     else:
                         logger.info(f"Playwright {description} 已是最新，无需下载。")
                     return True
 
-            # Command to install chromium browser
-            install_browser_cmd = [sys.executable, "-m",
-                                   "playwright", "install", "chromium"]
-            await run_playwright_command(install_browser_cmd, "Chromium 浏览器")
+            # Chromium 已存在时跳过安装命令：即使“已是最新”，它也要启动安装器子进程，拖慢插件加载
+            try:
+                chromium_ready = await self._renderer.chromium_installed()
+            except Exception as e:
+                logger.warning(f"检查 Chromium 安装状态失败，继续执行安装: {e}")
+                chromium_ready = False
+            if chromium_ready:
+                logger.info("Playwright Chromium 浏览器已安装，跳过安装。")
+            else:
+                # Command to install chromium browser
+                install_browser_cmd = [sys.executable, "-m",
+                                       "playwright", "install", "chromium"]
+                await run_playwright_command(install_browser_cmd, "Chromium 浏览器")
 
             # Command to install system dependencies
             # install-deps 在不少部署环境（容器/无 root 权限/只读系统）会失败。
             # 这里降级为“尽力而为”：失败只警告，不阻断插件加载。
-            install_deps_cmd = [sys.executable, "-m", "playwright", "install-deps"]
-            ok = await run_playwright_command(install_deps_cmd, "系统依赖")
-            if not ok:
-                logger.warning("Playwright 系统依赖安装失败/跳过：插件仍会加载，但首次渲染可能失败。请参考 Playwright 文档手动安装依赖。")
+            # 成功一次后写入标记文件，之后的启动不再重复执行
+            deps_marker = os.path.join(self.DATA_DIR, ".playwright_deps_installed")
+            if not os.path.exists(deps_marker):
+                install_deps_cmd = [sys.executable, "-m", "playwright", "install-deps"]
+                ok = await run_playwright_command(install_deps_cmd, "系统依赖")
+                if ok:
+                    with open(deps_marker, "w", encoding="utf-8"):
+                        pass
+                else:
+                    logger.warning("Playwright 系统依赖安装失败/跳过：插件仍会加载，但首次渲染可能失败。请参考 Playwright 文档手动安装依赖。")
+
+            # 预先启动常驻浏览器并预热 Page 池；失败时不阻断加载，首次渲染会再次尝试
+            try:
+                await self._renderer.warm_up(RENDER_SCALE, RENDER_WIDTH)
+            except Exception as e:
+                logger.warning(f"预启动 Playwright 浏览器失败，将在首次渲染时重试: {e}")
 
             logger.info("Markdown 转图片插件已初始化")
 
@@ -238,9 +1555,16 @@ class MarkdownConverterPlugin(Star):
                 "无法执行 Playwright 安装命令。请检查 Playwright Python 包是否已正确安装。")
         except Exception as e:
             logger.error(f"插件初始化过程中发生未知错误: {e}")
+        finally:
+            # 无论安装/预热成功与否都放行等待中的渲染，失败时由渲染自行重试启动浏览器
+            self._browser_ready.set()
 
     async def terminate(self):
         """插件停用时调用"""
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+        await self._renderer.close()
+        self._prep_executor.shutdown(wait=False)
         logger.info("Markdown 转图片插件已停止")
 
     @filter.command("md")
@@ -401,31 +1725,25 @@ class MarkdownConverterPlugin(Star):
                 event.set_extra("_md2img_sent_once", True)
             return
 
+        # 只处理纯文本部分，遇到 <md> 标签就替换为图片，否则保留原有内容。
+        # 各个 Plain 片段之间互不依赖，一并并发处理，而不是逐段等待渲染。
+        # _process_text_with_markdown 产出的纯文本已去掉所有 <md>/</md> 标签，
+        # 因此无需再对结果做一遍过滤
+        processed = await asyncio.gather(
+            *(
+                self._process_text_with_markdown(item.text)
+                for item in chain
+                if isinstance(item, Plain)
+            )
+        )
+        processed = iter(processed)
         new_chain = []
         for item in chain:
-            # 只处理纯文本部分，遇到 <md> 标签就替换为图片，否则保留原有内容
             if isinstance(item, Plain):
-                components = await self._process_text_with_markdown(item.text)
-                new_chain.extend(components)
+                new_chain.extend(next(processed))
             else:
                 new_chain.append(item)
-
-        # 只保留渲染后的图片和非 <md> 纯文本，去除原始纯文本，防止重复消息
-        # 如果 new_chain 里有图片，则移除所有原始 Plain（只保留图片和非 <md> 部分）
-        has_img = any(isinstance(comp, Image) for comp in new_chain)
-        if has_img:
-            # 只保留图片和非 <md> 的 Plain
-            filtered_chain = []
-            for comp in new_chain:
-                if isinstance(comp, Image):
-                    filtered_chain.append(comp)
-                elif isinstance(comp, Plain):
-                    # 只保留不含 <md> 的纯文本
-                    if "<md>" not in comp.text and "</md>" not in comp.text:
-                        filtered_chain.append(comp)
-            result.chain = filtered_chain
-        else:
-            result.chain = new_chain
+        result.chain = new_chain
 
         # 标记：/md 事件已经生成最终输出（防止平台超时重试导致二次发送）
         if is_md_command:
@@ -448,9 +1766,9 @@ class MarkdownConverterPlugin(Star):
                         parts.append({"type": "text", "text": comp.text})
                 elif isinstance(comp, Image):
                     try:
-                        bs64 = await comp.convert_to_base64()
+                        bs64 = await self._image_base64(comp)
                         if bs64:
-                            url = f"data:image/png;base64,{bs64}"
+                            url = f"data:image/{self.image_format};base64,{bs64}"
                             parts.append({"type": "image_url", "image_url": {"url": url}})
                     except Exception:
                         pass
@@ -463,7 +1781,7 @@ class MarkdownConverterPlugin(Star):
                 if not conv or not getattr(conv, "history", None):
                     return
 
-                history = json.loads(conv.history)
+                history = _json_loads(conv.history)
                 if not isinstance(history, list) or not history:
                     return
 
@@ -528,67 +1846,157 @@ class MarkdownConverterPlugin(Star):
         将其分割成 Plain 和 Image 组件的列表。
         """
         components = []
-        # 使用 re.split 来分割文本，保留分隔符（<md>...</md>）
-        # re.DOTALL 使得 '.' 可以匹配包括换行符在内的任意字符
-        pattern = r"(<md>.*?</md>)"
-        parts = re.split(pattern, text, flags=re.DOTALL)
-
-        for part in parts:
-            part = part.strip()
-            if not part:
+        # 待渲染的 <md> 块：(在 components 中的占位下标, Markdown 内容)
+        md_blocks = []
+        # 两个 <md> 块之间累积的纯文本片段（落单标签被丢弃后，两侧文本合并为一段）
+        pending_text = []
+
+        def flush_plain():
+            plain = "".join(pending_text).strip()
+            pending_text.clear()
+            if plain:
+                components.append(Plain(plain))
+
+        # 单次扫描：完整的 <md>...</md> 块与落单的 <md>/</md> 标签由同一个预编译正则识别
+        pos = 0
+        for match in _MD_TAG_RE.finditer(text):
+            pending_text.append(text[pos:match.start()])
+            pos = match.end()
+
+            md_content = match.group(1)
+            if md_content is None:
+                # 落单的 <md> 或 </md>：只丢弃标签本身，两侧文本按纯文本保留
                 continue
+            # 不允许嵌套：块内多出的 <md> 同样视为落单标签
+            md_content = md_content.replace("<md>", "").strip()
+            if not md_content:
+                continue
+            if len(md_content) > MAX_MD_LENGTH:
+                md_content = md_content[:MAX_MD_LENGTH] + "\n\n……（内容过长，已截断）"
 
-            # 检查当前部分是否是 <md> 标签
-            if part.startswith("<md>") and part.endswith("</md>"):
-                # 提取标签内的 Markdown 内容
-                md_content = part[4:-5].strip()
-                if not md_content:
-                    continue
+            flush_plain()
+            if _is_trivial_text(md_content):
+                # 无格式短句：按纯文本发送，不占用渲染
+                components.append(Plain(md_content))
+                continue
+            # 先占位，稍后并发渲染后按原顺序填回
+            md_blocks.append((len(components), md_content))
+            components.append(None)
+
+        pending_text.append(text[pos:])
+        flush_plain()
 
-                # 基于内容的缓存：同样的 md_content 不重复渲染
-                md_hash = hashlib.sha256(md_content.encode("utf-8")).hexdigest()
-                output_path = os.path.join(self.IMAGE_CACHE_DIR, f"{md_hash}.png")
+        # 多个 <md> 块并发渲染；并发度由 Page 池大小限制
+        images = await asyncio.gather(
+            *(self._render_md_block(md_content) for _, md_content in md_blocks)
+        )
+        for (index, _), image in zip(md_blocks, images):
+            components[index] = image
+
+        return [comp for comp in components if comp is not None]
+
+    async def _render_without_browser(self, md_content: str, output_path: str) -> bool:
+        """
+        尝试不经浏览器的快速路径：单个代码块走 Pygments，简单正文走 Pillow。
+
+        :return: 是否已生成图片；不适用或失败时返回 False，由浏览器渲染。
+        """
+        code_block = _match_single_code_block(md_content)
+        if code_block is not None:
+            render, args = _render_code_image, (*code_block, output_path, RENDER_SCALE)
+        elif _is_simple_markdown(md_content):
+            render, args = _render_simple_text, (md_content, output_path, RENDER_SCALE, RENDER_WIDTH)
+        else:
+            return False
 
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._prep_executor, render, *args)
+            return True
+        except Exception as e:
+            logger.warning(f"快速渲染失败，改用浏览器渲染: {e}")
+            return False
+
+    async def _image_base64(self, comp: Image) -> str:
+        """获取 Image 组件的 base64；本插件缓存目录中的图片复用此前的编码结果。"""
+        path = getattr(comp, "path", None)
+        if not path or not path.startswith(self.IMAGE_CACHE_DIR + os.sep):
+            return await comp.convert_to_base64()
+        bs64 = self._base64_cache.get(path)
+        if bs64 is not None:
+            self._base64_cache.move_to_end(path)
+            return bs64
+        bs64 = await asyncio.get_running_loop().run_in_executor(None, _file_base64, path)
+        if bs64 and len(bs64) <= BASE64_CACHE_MAX_BYTES and path not in self._base64_cache:
+            self._base64_cache[path] = bs64
+            self._base64_cache_bytes += len(bs64)
+            while self._base64_cache_bytes > BASE64_CACHE_MAX_BYTES:
+                _, evicted = self._base64_cache.popitem(last=False)
+                self._base64_cache_bytes -= len(evicted)
+        return bs64
+
+    async def _cache_sweeper(self):
+        """
+        后台任务：定期清理缓存目录，限制磁盘占用。
+        在默认线程池中执行，遍历缓存目录期间不占用处理 Markdown 解析与快速路径的 _prep_executor。
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                touched, self._cache_touched = self._cache_touched, {}
+                # 内存索引中的图片近期刚被使用，保留它们，索引也就不会指向已删除的文件
+                removed = await loop.run_in_executor(
+                    None, _prune_cache_dir, self.IMAGE_CACHE_DIR, CACHE_MAX_AGE_DAYS,
+                    self._cache_max_bytes, frozenset(self._cache_index.values()), touched,
+                )
+                if removed:
+                    logger.info(f"已清理 {removed} 张缓存图片")
+            except Exception as e:
+                logger.warning(f"清理图片缓存失败: {e}")
+            await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+
+    async def _render_to_file(self, md_content: str, output_path: str):
+        """生成图片：优先不经浏览器的快速路径，否则借用预热的 Page 渲染。"""
+        if not await self._render_without_browser(md_content, output_path):
+            # 插件刚加载时 Chromium 可能仍在安装：等待 initialize 完成，而不是立即启动失败
+            if not self._browser_ready.is_set():
                 try:
-                    # 如果缓存已存在且非空，直接复用
-                    if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0):
-                        # 调用库函数生成图片
-                        await markdown_to_image_playwright(
-                            md_text=md_content,
-                            output_image_path=output_path,
-                            scale=2,  # 2倍缩放以获得更高清的图片
-                            width=600  # 固定宽度为600px，内容过长会自动换行
-                        )
-
-                    if os.path.exists(output_path):
-                        # 如果图片成功生成，则添加到组件列表中
-                        components.append(Image.fromFileSystem(output_path))
-                    else:
-                        # 文件未生成，记录错误但不重发纯文本
-                        logger.error(f"Markdown 图片生成失败，但文件未找到: {output_path}")
-                except Exception as e:
-                    logger.error(f"调用 sync_markdown_to_image_playwright 异常: {e}")
+                    await asyncio.wait_for(self._browser_ready.wait(), timeout=BROWSER_READY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning("等待 Playwright 浏览器就绪超时，直接尝试渲染")
+            await self._renderer.render(md_content, output_path, RENDER_SCALE, RENDER_WIDTH)
+
+    async def _render_md_block(self, md_content: str):
+        """将单个 <md> 块渲染为 Image 组件；失败时返回 None。"""
+        # 基于内容的缓存：同样的 md_content（及渲染参数）不重复渲染
+        md_hash = _render_cache_key(md_content, RENDER_SCALE, RENDER_WIDTH)
+        output_path = self._cache_index.get(md_hash)
+        if output_path is not None:
+            self._cache_index.move_to_end(md_hash)
+            # 记录使用时间，离开索引后清理仍按最近使用时间判断新旧
+            self._cache_touched[output_path] = time.time()
+            return Image.fromFileSystem(output_path)
+        output_path = _cache_file_path(
+            self.IMAGE_CACHE_DIR, md_hash, IMAGE_EXTENSIONS[self.image_format]
+        )
+
+        try:
+            # 如果缓存已存在且非空，直接复用，并刷新修改时间使其不被当作过期文件清理
+            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                os.utime(output_path)
             else:
-                # 如果不是标签，就是普通文本
-                components.append(Plain(part))
-
-        return components
-    
-
-if __name__ == "__main__":
-    # 生成一个固定宽度的图片
-    output_file_fixed_width = f"markdown_width_{uuid.uuid4().hex[:6]}.png"
-    asyncio.run(markdown_to_image_playwright(
-        markdown_string,
-        output_file_fixed_width,
-        scale=2,
-        width=1000  # 设置宽度为 600px
-    ))
-
-    # 生成一个自适应宽度的图片(不设置 width 参数)
-    output_file_auto_width = f"markdown_auto_{uuid.uuid4().hex[:6]}.png"
-    asyncio.run(markdown_to_image_playwright(
-        markdown_string,
-        output_file_auto_width,
-        scale=2
-    ))
+                # 同一内容正在渲染时（如多人同时发出相同内容）直接等待那次渲染，不重复渲染。
+                # shield 保证某个等待方被取消时不会连带取消共享的渲染任务
+                task = self._inflight.get(md_hash)
+                if task is None:
+                    task = asyncio.ensure_future(self._render_to_file(md_content, output_path))
+                    self._inflight[md_hash] = task
+                    task.add_done_callback(lambda _: self._inflight.pop(md_hash, None))
+                await asyncio.shield(task)
+            # 两条渲染路径要么写出文件、要么抛出异常，无需再次 stat 确认
+            self._cache_index[md_hash] = output_path
+            while len(self._cache_index) > CACHE_INDEX_SIZE:
+                self._cache_index.popitem(last=False)
+            return Image.fromFileSystem(output_path)
+        except Exception as e:
+            logger.error(f"调用 sync_markdown_to_image_playwright 异常: {e}")
+        return None